@@ -1,17 +1,30 @@
 import streamlit as st
-from google.oauth2 import service_account
-from google.auth.transport.requests import Request
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import hashlib
+import random
+import threading
+import time
 import json
 
 # ---------------------------------------------------------
 # 1. 認証とトークン取得の設定
 # ---------------------------------------------------------
 SCOPES = ['https://www.googleapis.com/auth/drive']
+PREFETCH_COUNT = 5  # 一覧の上位何件の中身を先読みするか
+TOKEN_REFRESH_MARGIN = timedelta(seconds=60)  # 期限のこれだけ前になったらトークンを更新する
+RATE_LIMIT_RETRIES = 3  # レート制限で断られたときに送り直す回数
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}  # 403で返るレート制限の理由
+RETRY_AFTER_MAX = 10  # Retry-After に従って待つ最大秒数（1回の実行を長く止めない）
 
 @st.cache_resource
 def get_creds():
     """Secretsから認証情報を読み込む（ServiceオブジェクトではなくCreds自体を返す）"""
+    # google.auth 系は重いので実際に認証するときまでimportしない
+    from google.oauth2 import service_account
     try:
         creds_dict = st.secrets["gcp_service_account"]
         creds = service_account.Credentials.from_service_account_info(
@@ -22,55 +35,219 @@ def get_creds():
         st.error(f"認証設定エラー: {e}")
         return None
 
+@st.cache_resource
+def get_http_session():
+    """googleapis.com への接続を使い回すSessionを作成する（TLSハンドシェイクを毎回行わない）"""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=0.5,  # 指数バックオフ
+            # レート制限(429/403)は send_with_rate_limit_retry で待ち時間に上限を付けて送り直す
+            status_forcelist=[500, 502, 503, 504],
+            # 中身を丸ごと置き換えるPATCHは何度送っても同じ結果なので再試行する
+            # （新規作成のPOSTは5xxの時点で作成済みのことがあり、重複作成になりうるので対象外）
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"PATCH"},
+            respect_retry_after_header=False,
+            raise_on_status=False  # 最終的なレスポンスは各関数のステータス判定に任せる
+        )
+    )
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource
+def get_executor():
+    """Drive呼び出しを並列に流すスレッドプール（再実行のたびにスレッドを作らない）"""
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def get_token_lock():
+    """トークン更新を直列化するロック（再実行やセッションをまたいで共有する）"""
+    return threading.Lock()
+
 def get_access_token(creds):
-    """有効なアクセストークンを取得する"""
-    if not creds.valid:
-        creds.refresh(Request())
-    return creds.token
+    """有効なアクセストークンを取得する（期限切れ間近のときだけ更新する）"""
+    from google.auth.transport.requests import Request
+    with get_token_lock():
+        # creds.expiry はタイムゾーンなしのUTC
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if creds.token is None or creds.expiry is None or creds.expiry - now < TOKEN_REFRESH_MARGIN:
+            # トークン更新もプール済みのSessionを通して接続を使い回す
+            creds.refresh(Request(session=get_http_session()))
+        return creds.token
+
+def is_rate_limited(response):
+    """レート制限で断られたかどうか（Driveは429のほか、403に理由を付けて返すことがある）"""
+    if response.status_code == 429:
+        return True
+    if response.status_code != 403:
+        return False
+    try:
+        reasons = {e.get("reason") for e in response.json()["error"]["errors"]}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return False
+    return bool(reasons & RATE_LIMIT_REASONS)
+
+def send_with_rate_limit_retry(session, method, url, **kwargs):
+    """リクエストを送り、レート制限で断られたら待ってから送り直す
+    断られたリクエストは処理されていないので、新規作成のPOSTも重複せずに送り直せる
+    """
+    response = session.request(method, url, **kwargs)
+    for attempt in range(RATE_LIMIT_RETRIES):
+        if not is_rate_limited(response):
+            break
+        retry_after = response.headers.get("Retry-After", "")
+        delay = int(retry_after) if retry_after.isdigit() else 2 ** attempt + random.random()
+        time.sleep(min(delay, RETRY_AFTER_MAX))
+        response = session.request(method, url, **kwargs)
+    return response
 
 # ---------------------------------------------------------
 # 2. 軽量HTTPリクエストによるファイル操作
 # ---------------------------------------------------------
 
 def get_text_files_http(creds):
-    """ファイル一覧を取得 (GETリクエスト)"""
+    """ファイル一覧を取得 (GETリクエスト)
+    1ページ最大1000件で取得し、nextPageToken がある限り続きを取得する
+    失敗時は例外を投げる（空の一覧がキャッシュされないようにするため）
+    """
     token = get_access_token(creds)
     headers = {"Authorization": f"Bearer {token}"}
     params = {
         "q": "mimeType = 'text/plain' and trashed = false",
-        "pageSize": 20,
-        "fields": "files(id, name)",
+        "pageSize": 1000,
+        "fields": "nextPageToken, files(id, name, modifiedTime)",
         "orderBy": "modifiedTime desc"
     }
     
-    response = requests.get(
-        "https://www.googleapis.com/drive/v3/files",
-        headers=headers,
-        params=params
-    )
-    
-    if response.status_code == 200:
-        return response.json().get('files', [])
-    else:
-        st.error(f"一覧取得エラー: {response.text}")
-        return []
+    files = []
+    while True:
+        response = send_with_rate_limit_retry(
+            get_http_session(),
+            "GET",
+            "https://www.googleapis.com/drive/v3/files",
+            headers=headers,
+            params=params,
+            timeout=30
+        )
+        
+        if response.status_code != 200:
+            raise Exception(f"一覧取得エラー({response.status_code}): {response.text}")
+
+        result = response.json()
+        files.extend(result.get('files', []))
+        if not result.get('nextPageToken'):
+            return files
+        params["pageToken"] = result['nextPageToken']
+
+@st.cache_data(ttl=30, show_spinner=False)
+def get_text_files_cached(_creds):
+    """ファイル一覧をキャッシュする（再実行のたびにDriveへ問い合わせない）"""
+    return get_text_files_http(_creds)
 
 def read_file_http(creds, file_id):
-    """ファイルの中身を読む (GETリクエスト)"""
+    """ファイルの中身を読む (GETリクエスト)
+    失敗時は例外を投げる（空文字を返すとキャッシュされて空のファイルとして開いてしまうため）
+    """
     if not file_id: return ""
     token = get_access_token(creds)
     headers = {"Authorization": f"Bearer {token}"}
     
-    response = requests.get(
+    response = send_with_rate_limit_retry(
+        get_http_session(),
+        "GET",
         f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media",
-        headers=headers
+        headers=headers,
+        timeout=30
     )
     
     if response.status_code == 200:
-        return response.text
+        # 文字コード推定を通さずUTF-8として直接デコードする
+        return response.content.decode('utf-8', errors='replace')
     else:
-        st.error(f"読み込みエラー: {response.text}")
-        return ""
+        raise Exception(f"読み込みエラー({response.status_code}): {response.text}")
+
+@st.cache_data(show_spinner=False, max_entries=100)
+def read_file_cached(file_id, modified_time, _creds):
+    """ファイルの中身を(file_id, modifiedTime)ごとにキャッシュする（更新されれば別キーになる）"""
+    return read_file_http(_creds, file_id)
+
+def download_file_http(session, token, file_id):
+    """先読み用にファイルの中身を取得する（ワーカースレッドで動くのでstの関数は呼ばない）"""
+    response = send_with_rate_limit_retry(
+        session,
+        "GET",
+        f"https://www.googleapis.com/drive/v3/files/{file_id}?alt=media",
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=30
+    )
+    response.raise_for_status()
+    return response.content.decode('utf-8', errors='replace')
+
+def get_prefetched(file):
+    """先読み済みの中身を返す（modifiedTimeが一致しなければNone）"""
+    modified_time, content = st.session_state.prefetched.get(file['id'], (None, None))
+    return content if modified_time == file['modifiedTime'] else None
+
+def store_prefetched(file_id, modified_time, content):
+    """中身をfile_idごとに1つだけ保持する（古い版は上書きし、新しい版は古い版で上書きしない）"""
+    stored_time, _ = st.session_state.prefetched.get(file_id, (None, None))
+    if stored_time is None or stored_time <= modified_time:
+        st.session_state.prefetched[file_id] = (modified_time, content)
+
+def start_prefetch(creds, files):
+    """一覧の上位ファイルの読み込みを並列で開始する（結果は待たずに後の実行で回収する）"""
+    pending = st.session_state.prefetch_futures
+    failed = st.session_state.prefetch_failed
+    keys = [
+        (f['id'], f['modifiedTime']) for f in files[:PREFETCH_COUNT]
+        if get_prefetched(f) is None
+        and (f['id'], f['modifiedTime']) not in pending
+        and (f['id'], f['modifiedTime']) not in failed
+    ]
+    if not keys:
+        return
+
+    # トークンとSessionはメインスレッドで用意してワーカーに渡す
+    try:
+        token = get_access_token(creds)
+    except Exception:
+        return  # 先読みは補助的な処理なので、トークンが取れなければ今回は見送る
+    session = get_http_session()
+    executor = get_executor()
+    for key in keys:
+        pending[key] = executor.submit(download_file_http, session, token, key[0])
+
+def collect_prefetch():
+    """終わった先読みの結果だけをsession_stateに格納する（終わっていないものは待たずに次の実行へ持ち越す）"""
+    pending = st.session_state.prefetch_futures
+    for key, future in list(pending.items()):
+        if not future.done():
+            continue
+        del pending[key]
+        try:
+            store_prefetched(*key, future.result())
+        except Exception:
+            st.session_state.prefetch_failed.add(key)  # 失敗した先読みは繰り返さない
+
+def load_file_content(creds, f):
+    """ファイルの中身を返す（先読み済みならそれを使い、先読み中なら完了を待って二重に取得しない）"""
+    content = get_prefetched(f)
+    if content is not None:
+        return content
+    key = (f['id'], f['modifiedTime'])
+    future = st.session_state.prefetch_futures.pop(key, None)
+    if future is not None:
+        try:
+            content = future.result()
+        except Exception:
+            st.session_state.prefetch_failed.add(key)  # 通常の読み込みに任せてエラーを表示させる
+        else:
+            store_prefetched(*key, content)
+            return content
+    return read_file_cached(f['id'], f['modifiedTime'], creds)
 
 def create_file_http(creds, title, content):
     """
@@ -79,6 +256,7 @@ def create_file_http(creds, title, content):
     """
     token = get_access_token(creds)
     headers = {"Authorization": f"Bearer {token}"}
+    body = content.encode('utf-8')  # 一度だけエンコードしてそのまま送る
     
     # メタデータ
     metadata = {
@@ -89,37 +267,102 @@ def create_file_http(creds, title, content):
     # マルチパートアップロードの構築
     files = {
         'data': ('metadata', json.dumps(metadata), 'application/json; charset=UTF-8'),
-        'file': (title, content, 'text/plain')
+        'file': (title, body, 'text/plain; charset=utf-8')
     }
     
     # uploadType=multipart を使用
-    response = requests.post(
-        "https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart",
+    # fields でレスポンスを一覧の更新に使う項目だけに絞る（必要な項目はfieldsに明示的に追加する）
+    response = send_with_rate_limit_retry(
+        get_http_session(),
+        "POST",
+        "https://www.googleapis.com/upload/drive/v3/files?uploadType=multipart&fields=id,name,modifiedTime",
         headers=headers,
         files=files,
         timeout=60  # 60秒待機
     )
     
     if response.status_code == 200:
-        return response.json().get('id')
+        return response.json()
     else:
         raise Exception(f"作成エラー({response.status_code}): {response.text}")
 
 def update_file_http(creds, file_id, content):
-    """上書き保存 (PATCHリクエスト)"""
+    """上書き保存 (PATCHリクエスト)。更新後の id, name, modifiedTime を返す"""
     token = get_access_token(creds)
-    headers = {"Authorization": f"Bearer {token}"}
-    
+    body = content.encode('utf-8')  # 一度だけエンコードしてそのまま送る
+    headers = {
+        "Authorization": f"Bearer {token}",
+        "Content-Type": "text/plain; charset=utf-8"
+    }
+
     # uploadType=media で中身だけガツンと書き換える（最も軽量）
-    response = requests.patch(
-        f"https://www.googleapis.com/upload/drive/v3/files/{file_id}?uploadType=media",
+    # fields でレスポンスを一覧の更新に使う項目だけに絞る
+    response = send_with_rate_limit_retry(
+        get_http_session(),
+        "PATCH",
+        f"https://www.googleapis.com/upload/drive/v3/files/{file_id}?uploadType=media&fields=id,name,modifiedTime",
         headers=headers,
-        data=content.encode('utf-8'), # バイナリとして送る
+        data=body, # バイナリとして送る
         timeout=60
     )
     
     if response.status_code != 200:
         raise Exception(f"更新エラー({response.status_code}): {response.text}")
+    return response.json()
+
+@st.cache_resource
+def get_saved_files():
+    """保存したファイルの情報(id -> ファイル情報)。一覧のキャッシュが追いつくまで全セッションの一覧に重ねる"""
+    return {}
+
+def merge_saved_files(files):
+    """一覧に保存したファイルの情報を重ねる（一覧が同じか新しいmodifiedTimeを返したものは外す）"""
+    saved_files = get_saved_files()
+    listed = {f['id']: f for f in files}
+    for file_id, f in list(saved_files.items()):
+        if file_id in listed and listed[file_id]['modifiedTime'] >= f['modifiedTime']:
+            saved_files.pop(file_id, None)
+    saved = sorted(saved_files.values(), key=lambda f: f['modifiedTime'], reverse=True)
+    saved_ids = {f['id'] for f in saved}
+    return saved + [f for f in files if f['id'] not in saved_ids]
+
+def rebuild_file_index(listing):
+    """一覧と保存したファイルの情報から索引(id -> ファイル情報、新しい順)を作り直す
+    編集中のファイルが一覧から消えたときは、編集内容を失わないよう索引に残して印を付ける
+    """
+    file_index = {f['id']: f for f in merge_saved_files(listing)}
+    current = st.session_state.file_index.get(st.session_state.current_file_id)
+    st.session_state.missing_file_id = None
+    if current is not None and current['id'] not in file_index:
+        file_index[current['id']] = current
+        st.session_state.missing_file_id = current['id']
+    st.session_state.file_index = file_index
+    st.session_state.file_listing = listing
+    st.session_state.file_index_source = (listing, dict(get_saved_files()))
+
+def content_hash(content):
+    """保存前に変更の有無を判定するためのハッシュ"""
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).digest()
+
+def on_select_file(creds, files_by_id):
+    """selectboxで選ばれたファイルを読み込む（選択が変わったときだけ、スクリプトの実行前に呼ばれる）"""
+    selected = files_by_id.get(st.session_state.selected_file_id)
+    if selected is None:
+        st.session_state.current_file_id = None
+        st.session_state.input_title = "無題.txt"
+        st.session_state.input_content = ""
+        st.session_state.loaded_hash = None
+        return
+    try:
+        content = load_file_content(creds, selected)
+    except Exception as e:
+        # 読み込めなかったときは編集中のファイルをそのまま残す（選択も元に戻る）
+        st.session_state.load_error = f"読み込み失敗: {e}"
+        return
+    st.session_state.current_file_id = selected['id']
+    st.session_state.input_title = selected['name']
+    st.session_state.input_content = content
+    st.session_state.loaded_hash = content_hash(content)
 
 # ---------------------------------------------------------
 # 3. メインアプリケーション
@@ -138,59 +381,119 @@ def main():
         st.session_state.input_title = "無題.txt"
     if "input_content" not in st.session_state:
         st.session_state.input_content = ""
+    if "prefetched" not in st.session_state:
+        st.session_state.prefetched = {}
+    if "prefetch_futures" not in st.session_state:
+        st.session_state.prefetch_futures = {}
+    if "prefetch_failed" not in st.session_state:
+        st.session_state.prefetch_failed = set()
+    if "flash_message" not in st.session_state:
+        st.session_state.flash_message = None
+    if "loaded_hash" not in st.session_state:
+        st.session_state.loaded_hash = None
+    if "load_error" not in st.session_state:
+        st.session_state.load_error = None
+    if "file_index" not in st.session_state:
+        st.session_state.file_index = {}
+    if "file_listing" not in st.session_state:
+        st.session_state.file_listing = None
+    if "file_index_source" not in st.session_state:
+        st.session_state.file_index_source = None
+    if "missing_file_id" not in st.session_state:
+        st.session_state.missing_file_id = None
 
     # --- サイドバー ---
     with st.sidebar:
         st.header("ファイル一覧")
-        if st.button("＋ 新規作成", use_container_width=True):
-            st.session_state.current_file_id = None
-            st.session_state.input_title = "無題.txt"
-            st.session_state.input_content = ""
-            st.rerun()
+        # 一覧はキャッシュから出すので、最新を取り直したいときだけ明示的に破棄する
+        if st.button("🔄 一覧を更新", use_container_width=True):
+            get_text_files_cached.clear()
 
-        st.divider()
-
-        files = get_text_files_http(creds)
+        # 一覧はセッションごとの索引(id -> ファイル情報、新しい順)として持ち、実行のたびには作り直さない
+        # キャッシュの期限切れ・更新ボタン・保存で、一覧か保存したファイルの情報が変わったときだけ作り直す
+        # 取得に失敗したときは最後に取得できた一覧をそのまま使う
+        try:
+            listing = get_text_files_cached(creds)
+        except Exception as e:
+            st.error(f"一覧取得失敗: {e}")
+            listing = st.session_state.file_listing
+        if listing is not None and (listing, get_saved_files()) != st.session_state.file_index_source:
+            rebuild_file_index(listing)
+        files_by_id = st.session_state.file_index
+        files = list(files_by_id.values())
         if not files:
             st.write("テキストファイルがありません")
-        
-        for f in files:
-            if st.button(f['name'], key=f['id'], use_container_width=True):
-                st.session_state.current_file_id = f['id']
-                st.session_state.input_title = f['name']
-                st.session_state.input_content = read_file_http(creds, f['id'])
-                st.rerun()
+        # 前の実行までに終わった先読みを回収してから、足りない分を新たに始める
+        collect_prefetch()
+        start_prefetch(creds, files)
+
+        # ファイルごとのボタンではなく1つのselectboxで選ぶ（先頭のNoneが新規作成）
+        # 選択はキーで保持し、読み込みはon_changeで行うので選択後に再実行しなくてよい
+        # 選択肢はファイルIDにして、名前やファイル情報はIDをキーにした辞書で引く
+        # ウィジェットを作る前に、選択を編集中のファイルに合わせておく（保存後や読み込み失敗後も一致させる）
+        current_file_id = st.session_state.current_file_id
+        st.session_state.selected_file_id = current_file_id if current_file_id in files_by_id else None
+        st.selectbox(
+            "📄 ファイル",
+            [None] + list(files_by_id),
+            key="selected_file_id",
+            format_func=lambda file_id: "＋ 新規作成" if file_id is None else files_by_id[file_id]['name'],
+            on_change=on_select_file,
+            args=(creds, files_by_id)
+        )
+        if st.session_state.load_error:
+            st.error(st.session_state.load_error)
+            st.session_state.load_error = None
+        missing_file_id = st.session_state.missing_file_id
+        if missing_file_id is not None and missing_file_id == st.session_state.current_file_id:
+            st.warning("編集中のファイルが一覧にありません（別の場所で削除された可能性があります）")
 
     # --- メイン画面 ---
+    if st.session_state.flash_message:
+        st.success(st.session_state.flash_message)
+        st.session_state.flash_message = None
+
     if st.session_state.current_file_id is None:
         st.info("🆕 新規作成モード (Direct API)")
     else:
         st.caption(f"編集中ID: {st.session_state.current_file_id}")
 
-    title = st.text_input("ファイル名", value=st.session_state.input_title)
-    content = st.text_area("内容", value=st.session_state.input_content, height=400)
+    # フォームにまとめて、入力のたびではなく保存ボタンを押したときだけ再実行する
+    with st.form("editor_form", clear_on_submit=False):
+        title = st.text_input("ファイル名", value=st.session_state.input_title)
+        content = st.text_area("内容", value=st.session_state.input_content, height=400)
+        submitted = st.form_submit_button("保存する", type="primary")
 
-    if st.button("保存する", type="primary"):
+    if submitted:
         if not title:
             st.warning("ファイル名を入力してください。")
+        elif (st.session_state.current_file_id is not None
+              and title == st.session_state.input_title
+              and content_hash(content) == st.session_state.loaded_hash):
+            # 読み込んだときから何も変わっていなければアップロードしない
+            st.toast("変更なし")
         else:
             try:
                 with st.spinner("保存中..."):
                     if st.session_state.current_file_id is None:
                         # 新規作成
-                        new_id = create_file_http(creds, title, content)
-                        st.session_state.current_file_id = new_id 
-                        st.success(f"作成完了！ ID: {new_id}")
+                        saved = create_file_http(creds, title, content)
+                        st.session_state.current_file_id = saved['id']
+                        st.session_state.flash_message = f"作成完了！ ID: {saved['id']}"
                     else:
                         # 上書き
-                        update_file_http(creds, st.session_state.current_file_id, content)
-                        st.success("上書き完了！")
+                        saved = update_file_http(creds, st.session_state.current_file_id, content)
+                        st.session_state.flash_message = "上書き完了！"
                 
+                # 一覧を取り直さずに保存結果を全セッションの一覧に重ね、保存した中身もそのまま再利用する
+                get_saved_files()[saved['id']] = saved
+                store_prefetched(saved['id'], saved['modifiedTime'], content)
+
                 st.session_state.input_title = title
                 st.session_state.input_content = content
+                st.session_state.loaded_hash = content_hash(content)
                 
-                import time
-                time.sleep(1)
+                # メッセージは再実行後に表示するので待たずにすぐ再実行する
                 st.rerun()
                 
             except Exception as e: